@@ -10,12 +10,33 @@ Example:
         # current_service = api.service
         ...
 """
+from anthill.framework.db import db
+from anthill.framework.utils.asynchronous import as_future
 from anthill.platform.api.internal import as_internal, InternalAPI
 from moderation.models import ModerationAction
+from moderation.utils import nplusone_profiler
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def moderations_schema():
+    # Built on first use, once mappers are configured
+    return ModerationAction.__marshmallow__(many=True, only=ModerationAction.DUMP_FIELDS)
+
+
+@as_future
+def dump_moderations(user_id: str) -> dict:
+    # Load and dump in one executor call, so N+1 profiling sees the whole work
+    try:
+        with nplusone_profiler():
+            objects = ModerationAction.actions_query(
+                user_id, columns=ModerationAction.DUMP_FIELDS).all()
+            return moderations_schema().dump(objects).data
+    finally:
+        # Executor thread session, end its transaction and release connection
+        db.session.remove()
 
 
 @as_internal()
 async def get_moderations(api: InternalAPI, user_id: str) -> dict:
-    objects = ModerationAction.actions_query(user_id).all()
-    result = ModerationAction.dump_many(objects).data
-    return result
+    return await dump_moderations(user_id)
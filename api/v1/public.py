@@ -1,6 +1,95 @@
 import graphene
+from anthill.framework.conf import settings
 from graphene_sqlalchemy import SQLAlchemyObjectType
+from graphql import GraphQLError, validate
+from graphql.backend import GraphQLCachedBackend, GraphQLCoreBackend
+from graphql.backend.base import GraphQLDocument
+from graphql.execution import ExecutionResult, execute
+from graphql.validation.rules import specified_rules
+from graphql.validation.rules.base import ValidationRule
 from moderation import models
+from collections import OrderedDict
+from functools import partial
+
+
+DOCUMENT_CACHE_SIZE = 1024
+
+
+class DisableIntrospection(ValidationRule):
+    def enter_Field(self, node, *args):
+        if node.name.value in ('__schema', '__type'):
+            self.context.report_error(
+                GraphQLError('Schema introspection is disabled.', [node]))
+
+
+def execute_validated(schema, document_ast, validation_errors, *args, **kwargs):
+    if kwargs.pop('validate', True) and validation_errors:
+        return ExecutionResult(errors=validation_errors, invalid=True)
+    return execute(schema, document_ast, *args, **kwargs)
+
+
+class ValidatingBackend(GraphQLCoreBackend):
+    """Core backend validating documents once, when created, with given rules."""
+
+    def __init__(self, rules, executor=None):
+        super().__init__(executor)
+        self.rules = rules
+
+    def document_from_string(self, schema, document_string):
+        document = super().document_from_string(schema, document_string)
+        errors = validate(schema, document.document_ast, self.rules)
+        return GraphQLDocument(
+            schema=schema,
+            document_string=document.document_string,
+            document_ast=document.document_ast,
+            execute=partial(execute_validated, schema, document.document_ast,
+                            errors, **self.execute_params)
+        )
+
+
+class DocumentCache(OrderedDict):
+    """Documents cache keeping `maxsize` most recently used entries."""
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+def get_validation_rules():
+    rules = list(specified_rules)
+    if not settings.GRAPHENE.get('INTROSPECTION', True):
+        rules.append(DisableIntrospection)
+    return rules
+
+
+def get_backend():
+    """Backend parsing and validating each distinct query once."""
+    return GraphQLCachedBackend(
+        ValidatingBackend(get_validation_rules()),
+        cache_map=DocumentCache(DOCUMENT_CACHE_SIZE))
+
+
+class Schema(graphene.Schema):
+    """Schema executing queries with given backend, unless caller passes one."""
+
+    def __init__(self, *args, backend=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backend = backend
+
+    def execute(self, *args, **kwargs):
+        if self.backend is not None:
+            kwargs.setdefault('backend', self.backend)
+        return super().execute(*args, **kwargs)
 
 
 class RootQuery(graphene.ObjectType):
@@ -8,4 +97,4 @@ class RootQuery(graphene.ObjectType):
 
 
 # noinspection PyTypeChecker
-schema = graphene.Schema(query=RootQuery)
+schema = Schema(query=RootQuery, backend=get_backend())
@@ -1 +1,7 @@
 # Cache related code here, cache key methods for example.
+
+WARNING_THRESHOLD_TIMEOUT = 60 * 60
+
+
+def warning_threshold_key(action_type: str) -> str:
+    return 'warning_threshold:%s' % action_type
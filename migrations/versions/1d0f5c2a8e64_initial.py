@@ -0,0 +1,49 @@
+"""Initial schema
+
+Revision ID: 1d0f5c2a8e64
+Revises: 
+Create Date: 2026-10-15 09:58:12.660351
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '1d0f5c2a8e64'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def action_columns():
+    return [
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('action_type', sa.Unicode(255), nullable=False),
+        sa.Column('moderator_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('reason', sa.String(512), nullable=False),
+        sa.Column('is_active', sa.Boolean(), nullable=False),
+        sa.Column('extra_data', postgresql.JSON(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    ]
+
+
+def upgrade():
+    op.create_table('actions', *action_columns(), sa.Column('finish_at', sa.DateTime(), nullable=True))
+    op.create_table('warnings', *action_columns())
+    op.create_table(
+        'warning_thresholds',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('action_type', sa.Unicode(255), nullable=False),
+        sa.Column('value', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('action_type'),
+    )
+
+
+def downgrade():
+    op.drop_table('warning_thresholds')
+    op.drop_table('warnings')
+    op.drop_table('actions')
@@ -0,0 +1,28 @@
+"""Add active actions indexes
+
+Revision ID: 3f1c9a7d2b10
+Revises: 1d0f5c2a8e64
+Create Date: 2026-10-15 10:12:31.402113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a7d2b10'
+down_revision = '1d0f5c2a8e64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actions_user_active_type', 'actions', ['user_id', 'action_type'],
+                    postgresql_where=sa.text('is_active'))
+    op.create_index('ix_warnings_user_active_type', 'warnings', ['user_id', 'action_type'],
+                    postgresql_where=sa.text('is_active'))
+
+
+def downgrade():
+    op.drop_index('ix_warnings_user_active_type', table_name='warnings')
+    op.drop_index('ix_actions_user_active_type', table_name='actions')
@@ -0,0 +1,34 @@
+"""Store extra_data as jsonb with server default
+
+Revision ID: 8b2e4d6f0a93
+Revises: 3f1c9a7d2b10
+Create Date: 2026-10-15 12:40:08.517264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4d6f0a93'
+down_revision = '3f1c9a7d2b10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('actions', 'warnings'):
+        op.alter_column(table, 'extra_data',
+                        type_=postgresql.JSONB(),
+                        existing_nullable=False,
+                        server_default=sa.text("'{}'::jsonb"),
+                        postgresql_using='extra_data::jsonb')
+
+
+def downgrade():
+    for table in ('actions', 'warnings'):
+        op.alter_column(table, 'extra_data',
+                        type_=postgresql.JSON(),
+                        existing_nullable=False,
+                        server_default=None,
+                        postgresql_using='extra_data::json')
@@ -0,0 +1,32 @@
+"""Store action_type as plain string
+
+Revision ID: c47a1e9b5d28
+Revises: 8b2e4d6f0a93
+Create Date: 2026-10-15 14:05:51.130448
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47a1e9b5d28'
+down_revision = '8b2e4d6f0a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('actions', 'warnings', 'warning_thresholds'):
+        op.alter_column(table, 'action_type',
+                        type_=sa.String(32),
+                        existing_type=sa.Unicode(255),
+                        existing_nullable=False)
+
+
+def downgrade():
+    for table in ('actions', 'warnings', 'warning_thresholds'):
+        op.alter_column(table, 'action_type',
+                        type_=sa.Unicode(255),
+                        existing_type=sa.String(32),
+                        existing_nullable=False)
@@ -0,0 +1,28 @@
+"""Add active actions by finish time index
+
+Revision ID: e91d3b7c6f40
+Revises: c47a1e9b5d28
+Create Date: 2026-10-15 15:22:47.905316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e91d3b7c6f40'
+down_revision = 'c47a1e9b5d28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actions_user_finish', 'actions', ['user_id', 'finish_at'],
+                    postgresql_where=sa.text('is_active'))
+    op.drop_index('ix_actions_user_active_type', table_name='actions')
+
+
+def downgrade():
+    op.create_index('ix_actions_user_active_type', 'actions', ['user_id', 'action_type'],
+                    postgresql_where=sa.text('is_active'))
+    op.drop_index('ix_actions_user_finish', table_name='actions')
@@ -2,44 +2,83 @@
 # http://docs.sqlalchemy.org/en/latest/orm/tutorial.html#declare-a-mapping
 from anthill.framework.db import db
 from anthill.framework.conf import settings
+from anthill.framework.core.cache import cache
 from anthill.framework.utils import timezone
 from anthill.framework.utils.asynchronous import as_future
 from anthill.framework.utils.translation import translate_lazy as _
 from anthill.platform.api.internal import InternalAPIMixin
 from anthill.platform.auth import RemoteUser
+from sqlalchemy import and_, bindparam, event, func, insert, inspect, or_, select, text, tuple_, union_all
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy_utils.types.json import JSONType
-from sqlalchemy_utils.types.choice import ChoiceType
-from datetime import timedelta
+from sqlalchemy.orm import Session, load_only, object_session, validates
+from datetime import datetime, timedelta
 from functools import partial
+from itertools import chain
 from typing import Optional
+import asyncio
+import logging
+from moderation.cache import warning_threshold_key, WARNING_THRESHOLD_TIMEOUT
+
+
+logger = logging.getLogger('anthill.application')
 
 
 DEFAULT_MODERATION_WARNING_THRESHOLD = 3
 
 
+bakery = baked.bakery()
+
+
 ACTION_TYPES = (
     ('ban_account', _('Ban account')),
     ('hide_message', _('Hide message')),
     ('ban_game', _('Ban in game')),
 )
+ACTION_TYPE_SET = frozenset(code for code, label in ACTION_TYPES)
+
+
+def current_time():
+    """
+    Current time bound as a parameter, evaluated on each statement execution.
+    Stored times are written with `timezone.now()`, so compare against
+    the same clock rather than database `now()`.
+    """
+    return bindparam('now', callable_=timezone.now, type_=db.DateTime, unique=True)
+
+
+def validate_action_type(action_type: str) -> str:
+    if action_type not in ACTION_TYPE_SET:
+        raise ValueError('Unknown action type: %s' % action_type)
+    return action_type
 
 
 class BaseModerationAction(InternalAPIMixin, db.Model):
     __abstract__ = True
 
+    # Fields loaded and serialized for actions lists
+    DUMP_FIELDS = ('id', 'action_type', 'created_at', 'is_active', 'moderator_id', 'user_id')
+
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    action_type = db.Column(ChoiceType(ACTION_TYPES), nullable=False)
+    action_type = db.Column(db.String(32), nullable=False)
+    # Users are remote, resolved through login service (see `get_user`).
+    # If they ever become relationships, declare them with lazy='raise_on_sql'
+    # and load lists with selectinload, so no per-row lazy loads sneak in.
     moderator_id = db.Column(db.Integer, nullable=False)
     user_id = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=timezone.now)
     reason = db.Column(db.String(512), nullable=False)
     is_active = db.Column(db.Boolean, nullable=False, default=True)
-    extra_data = db.Column(JSONType, nullable=False, default={})
+    extra_data = db.Column(JSONB, nullable=False, server_default=text("'{}'::jsonb"))
 
     def __init__(self, **kwargs):  # for IDE inspection
         super().__init__(**kwargs)
 
+    @validates('action_type')
+    def _validate_action_type(self, key, action_type):
+        return validate_action_type(action_type)
+
     @property
     def request_user(self):
         return partial(self.internal_request, 'login', 'get_user')
@@ -69,9 +108,45 @@ class BaseModerationAction(InternalAPIMixin, db.Model):
         return self.is_active
 
     @classmethod
-    async def actions_query(cls, user_id: str, **filters) -> db.Query:
-        """Get actions query for current user id."""
-        return cls.query.filter_by(active=True, user_id=user_id, **filters)
+    def actions_query(cls, user_id: str, columns: Optional[tuple] = None, **filters) -> baked.Result:
+        """
+        Get actions query for current user id.
+        If `columns` given, only these columns are loaded.
+
+        Query is baked, so its construction and SQL compilation are cached
+        by model, filter names and columns; values are bound as parameters.
+        """
+        query = bakery(lambda session: session.query(cls), cls)
+        query += lambda q: q.filter(cls.active, cls.user_id == bindparam('user_id'))
+        for key in sorted(filters):
+            query.add_criteria(
+                lambda q, key=key: q.filter(getattr(cls, key) == bindparam(key)), key)
+        if columns:
+            query.add_criteria(lambda q: q.options(load_only(*columns)), columns)
+        return query(db.session()).params(user_id=user_id, **filters)
+
+    @staticmethod
+    def entry_rows(entries: list, now: datetime) -> list:
+        """
+        Build table rows from `moderate`/`warn` like arguments.
+        `extra_data` is left to server default unless some entry has it,
+        since multi-row insert requires the same columns in all rows.
+        """
+        rows = [
+            dict(
+                action_type=validate_action_type(entry['action_type']),
+                reason=entry['reason'],
+                moderator_id=entry['moderator'].id,
+                user_id=entry['user'].id,
+                created_at=now,
+                is_active=True
+            )
+            for entry in entries
+        ]
+        if any(entry.get('extra_data') is not None for entry in entries):
+            for row, entry in zip(rows, entries):
+                row['extra_data'] = entry.get('extra_data') or {}
+        return rows
 
     @staticmethod
     async def send_email(user: RemoteUser, subject, message, from_email=None, **kwargs):
@@ -81,10 +156,46 @@ class BaseModerationAction(InternalAPIMixin, db.Model):
     async def send_message(user: RemoteUser, message):
         await user.send_message(message)
 
+    @classmethod
+    async def notify(cls, user: RemoteUser, subject, message):
+        """Send email and message to user concurrently."""
+        await asyncio.gather(
+            cls.send_email(
+                user,
+                subject=subject,
+                message=message,
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                fail_silently=False,
+                html_message=None
+            ),
+            cls.send_message(user, message=message)
+        )
+
+    @classmethod
+    async def notify_all(cls, notifications: list) -> None:
+        """
+        Notify users concurrently, `notifications` is a list
+        of (user, subject, message).
+        Called after commit, so failures are logged, not raised:
+        actions are saved whether users are notified or not.
+        """
+        results = await asyncio.gather(
+            *(cls.notify(user, subject, message) for user, subject, message in notifications),
+            return_exceptions=True
+        )
+        for (user, subject, message), result in zip(notifications, results):
+            if isinstance(result, Exception):
+                logger.error('Cannot notify user %s.', user.id, exc_info=result)
+
 
 class ModerationAction(BaseModerationAction):
     __tablename__ = 'actions'
-    __table_args__ = ()
+    __table_args__ = (
+        db.Index('ix_actions_user_finish', 'user_id', 'finish_at',
+                 postgresql_where=text('is_active')),
+    )
+
+    DUMP_FIELDS = BaseModerationAction.DUMP_FIELDS + ('finish_at',)
 
     finish_at = db.Column(db.DateTime)
 
@@ -96,91 +207,241 @@ class ModerationAction(BaseModerationAction):
         if self.time_limited:
             return self.finish_at - timezone.now()
 
+    def is_finished(self, now: Optional[datetime] = None) -> bool:
+        """
+        Check if time limited action is over.
+        Pass `now` to evaluate a batch of actions against the same time.
+        """
+        if self.time_limited:
+            return self.finish_at <= (now or timezone.now())
+        return False
+
     @hybrid_property
     def finished(self) -> bool:
-        if self.time_limited:
-            return self.finish_at <= timezone.now()
-        return True
+        return self.is_finished()
+
+    @finished.expression
+    def finished(cls):
+        return and_(cls.finish_at.isnot(None), cls.finish_at <= current_time())
 
     @hybrid_property
     def active(self) -> bool:
         return self.is_active and not self.finished
 
     @active.expression
-    def active(cls) -> bool:
-        return cls.is_active and not cls.finished
+    def active(cls):
+        return and_(cls.is_active, or_(cls.finish_at.is_(None), cls.finish_at > current_time()))
 
     @classmethod
     async def moderate(cls, action_type: str, reason: str,
                        moderator: RemoteUser, user: RemoteUser,
                        extra_data: Optional[dict] = None, finish_at=None,
-                       commit=True):
-        data = dict(
+                       commit=True) -> int:
+        """
+        Moderate user and notify about it, return id of created action.
+        Notification is sent after commit, its failure is logged
+        and does not fail moderation.
+        If `commit` is not set, action joins the caller's transaction
+        and nobody is notified: the caller must commit and then call
+        `notify_moderated` with a dict of the same arguments.
+        """
+        entry = dict(
             action_type=action_type,
             reason=reason,
-            moderator_id=moderator.id,
-            user_id=user.id,
-            finish_at=finish_at,
-            extra_data=extra_data
+            moderator=moderator,
+            user=user,
+            extra_data=extra_data,
+            finish_at=finish_at
         )
-        obj = cls(**data)
-        db.session.add(obj)
-        if commit:
+        action_id, = await cls.bulk_moderate([entry], commit=commit)
+        return action_id
+
+    @classmethod
+    async def bulk_moderate(cls, entries: list, commit=True) -> list:
+        """
+        Moderate users with a single insert.
+        Each entry is a dict of `moderate` arguments.
+        Returns ids of created actions.
+        If `commit` is set, actions are saved off the event loop and users
+        are notified after commit. Otherwise actions join the caller's
+        transaction, and it is up to the caller to commit
+        and `notify_moderated`.
+        """
+        if not entries:
+            return []
+        if not commit:
+            # In the caller's thread, so in its (thread scoped) session
+            return cls.insert_actions(entries)
+        ids = await cls.save_actions(entries)
+        await cls.notify_moderated(entries)
+        return ids
+
+    @classmethod
+    def insert_actions(cls, entries: list) -> list:
+        """Insert actions in current transaction, return their ids."""
+        now = timezone.now()
+        rows = [dict(row, finish_at=entry.get('finish_at'))
+                for row, entry in zip(cls.entry_rows(entries, now), entries)]
+        stmt = insert(cls.__table__).values(rows).returning(cls.__table__.c.id)
+        return [row.id for row in db.session.execute(stmt)]
+
+    @classmethod
+    @as_future
+    def save_actions(cls, entries: list) -> list:
+        """Insert actions and commit, return their ids."""
+        try:
+            ids = cls.insert_actions(entries)
             db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
 
-        await cls.send_email(
-            user,
-            subject=_('You are moderated'),
-            message=reason,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            fail_silently=False,
-            html_message=None
-        )
-        await cls.send_message(user, message=reason)
+    @classmethod
+    def active_keys(cls, keys: set) -> set:
+        """Get (user_id, action_type) pairs of `keys` with active actions."""
+        if not keys:
+            return set()
+        stmt = select([cls.user_id, cls.action_type]).distinct().where(and_(
+            cls.active,
+            tuple_(cls.user_id, cls.action_type).in_(keys)
+        ))
+        return {tuple(row) for row in db.session.execute(stmt)}
+
+    @classmethod
+    def moderated_notifications(cls, entries: list) -> list:
+        return [(entry['user'], _('You are moderated'), entry['reason']) for entry in entries]
+
+    @classmethod
+    async def notify_moderated(cls, entries: list) -> None:
+        await cls.notify_all(cls.moderated_notifications(entries))
 
 
 class ModerationWarning(BaseModerationAction):
     __tablename__ = 'warnings'
-    __table_args__ = ()
+    __table_args__ = (
+        db.Index('ix_warnings_user_active_type', 'user_id', 'action_type',
+                 postgresql_where=text('is_active')),
+    )
 
-    @property
-    def threshold_model(self):
-        return ModerationWarningThreshold
+    @classmethod
+    def get_threshold(cls, action_type: str) -> int:
+        """Get warnings threshold value for action type, cached."""
+        key = warning_threshold_key(action_type)
+        value = cache.get(key)
+        if value is None:
+            threshold = ModerationWarningThreshold.query.filter_by(action_type=action_type).first()
+            value = threshold.value if threshold is not None else DEFAULT_MODERATION_WARNING_THRESHOLD
+            cache.set(key, value, WARNING_THRESHOLD_TIMEOUT)
+        return value
+
+    @classmethod
+    def lock_warnings(cls, user_id: int, action_type: str) -> None:
+        """
+        Serialize warnings of the same type for the user
+        until the end of current transaction.
+        """
+        lock = func.pg_advisory_xact_lock(user_id, func.hashtext(action_type))
+        db.session.execute(select([lock]))
+
+    @classmethod
+    def insert_warnings(cls, rows: list) -> dict:
+        """
+        Insert warnings and return active warnings counts
+        by (user_id, action_type), including inserted ones,
+        with a single statement.
+        """
+        if not rows:
+            return {}
+        table = cls.__table__
+        keys = {(row['user_id'], row['action_type']) for row in rows}
+        inserted = insert(table).values(rows) \
+            .returning(table.c.user_id, table.c.action_type).cte('inserted')
+        existing = select([table.c.user_id, table.c.action_type]).where(and_(
+            table.c.is_active,
+            tuple_(table.c.user_id, table.c.action_type).in_(keys)
+        ))
+        warnings = union_all(existing, select([inserted.c.user_id, inserted.c.action_type])).alias()
+        stmt = select([warnings.c.user_id, warnings.c.action_type, func.count()]) \
+            .group_by(warnings.c.user_id, warnings.c.action_type)
+        return {
+            (user_id, action_type): count
+            for user_id, action_type, count in db.session.execute(stmt)
+        }
 
     @classmethod
     async def warn(cls, action_type: str, reason: str,
                    moderator: RemoteUser, user: RemoteUser,
                    finish_at=None, extra_data: Optional[dict] = None):
-        data = dict(
+        """
+        Warn user, moderate if warnings threshold is reached,
+        and notify about it.
+        Notification is sent after commit, its failure is logged
+        and does not fail the warning.
+        """
+        entry = dict(
             action_type=action_type,
             reason=reason,
-            moderator_id=moderator.id,
-            user_id=user.id,
-            extra_data=extra_data
+            moderator=moderator,
+            user=user,
+            extra_data=extra_data,
+            finish_at=finish_at
         )
-        obj = cls(**data)
-        db.session.add(obj)
+        await cls.bulk_warn([entry])
+
+    @classmethod
+    async def bulk_warn(cls, entries: list) -> None:
+        """
+        Warn users with a single insert.
+        Each entry is a dict of `warn` arguments.
+        Users reaching warnings threshold are moderated,
+        once per action type.
+        """
+        if not entries:
+            return
+        moderations = await cls.save_warnings(entries)
+
+        notifications = ModerationAction.moderated_notifications(list(moderations.values()))
+        notifications += [
+            (entry['user'], _('You are warned'), entry['reason'])
+            for entry in entries
+            if (entry['user'].id, entry['action_type']) not in moderations
+        ]
+        await cls.notify_all(notifications)
 
+    @classmethod
+    @as_future
+    def save_warnings(cls, entries: list) -> dict:
+        """
+        Insert warnings and moderate users reaching threshold
+        in a single transaction.
+        Users already having active action of the type are not moderated again.
+        Returns moderated entries by (user_id, action_type).
+        """
+        rows = cls.entry_rows(entries, timezone.now())
         try:
-            warns_count = await cls.actions_query(user.id, action_type=action_type).count()
-            threshold = cls.threshold_model.query.filter_by(action_type=action_type).first()
-            if warns_count >= threshold.value:
-                await cls.moderate(action_type, reason, moderator, user, extra_data,
-                                   finish_at, commit=False)
-            else:
-                await cls.send_email(
-                    user,
-                    subject=_('You are warned'),
-                    message=reason,
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    fail_silently=False,
-                    html_message=None
-                )
-                await cls.send_message(user, message=reason)
+            # Resolved once per action type, before taking locks
+            thresholds = {
+                action_type: cls.get_threshold(action_type)
+                for action_type in {row['action_type'] for row in rows}
+            }
+            for user_id, action_type in sorted({(r['user_id'], r['action_type']) for r in rows}):
+                cls.lock_warnings(user_id, action_type)
+            warns_counts = cls.insert_warnings(rows)
+            moderations = {}
+            for entry in entries:
+                key = (entry['user'].id, entry['action_type'])
+                if warns_counts[key] >= thresholds[entry['action_type']]:
+                    moderations[key] = entry
+            for key in ModerationAction.active_keys(set(moderations)):
+                del moderations[key]
+            if moderations:
+                ModerationAction.insert_actions(list(moderations.values()))
             db.session.commit()
         except Exception:
             db.session.rollback()
             raise
+        return moderations
 
 
 class ModerationWarningThreshold(db.Model):
@@ -188,6 +449,31 @@ class ModerationWarningThreshold(db.Model):
     __table_args__ = ()
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    action_type = db.Column(ChoiceType(ACTION_TYPES), unique=True, nullable=False)
+    action_type = db.Column(db.String(32), unique=True, nullable=False)
     value = db.Column(db.Integer, nullable=False,
                       default=DEFAULT_MODERATION_WARNING_THRESHOLD)
+
+    @validates('action_type')
+    def _validate_action_type(self, key, action_type):
+        return validate_action_type(action_type)
+
+
+@event.listens_for(ModerationWarningThreshold, 'after_insert')
+@event.listens_for(ModerationWarningThreshold, 'after_update')
+@event.listens_for(ModerationWarningThreshold, 'after_delete')
+def on_warning_threshold_change(mapper, connection, target):
+    # Collect keys now, invalidate after commit: deleting at flush time lets
+    # a concurrent reader cache the old committed value again.
+    # Keys left by a rolled back transaction only cause an extra invalidation.
+    session = object_session(target)
+    keys = session.info.setdefault('warning_threshold_keys', set())
+    history = inspect(target).attrs.action_type.history
+    for action_type in chain(history.deleted, [target.action_type]):
+        keys.add(warning_threshold_key(action_type))
+
+
+@event.listens_for(Session, 'after_commit')
+def on_session_commit(session):
+    keys = session.info.pop('warning_threshold_keys', None)
+    if keys:
+        cache.delete_many(keys)
@@ -1,5 +1,40 @@
+from anthill.framework.conf import settings
+from anthill.framework.core.exceptions import ImproperlyConfigured
+from anthill.framework.db import db
+from anthill.framework.utils.asynchronous import as_future
 from anthill.platform.services import PlainService
+import logging
+
+logger = logging.getLogger('anthill.application')
+
+
+@as_future
+def warm_up_db_pool():
+    """
+    Open `DB_POOL_WARM_UP` connections (at most `pool_size`) up front
+    to avoid cold start on first requests.
+    """
+    count = min(settings.DB_POOL_WARM_UP, db.engine.pool.size())
+    connections = []
+    try:
+        for _ in range(count):
+            connection = db.engine.connect()
+            connections.append(connection)
+            connection.execute('SELECT 1')
+    finally:
+        for connection in connections:
+            connection.close()
 
 
 class Service(PlainService):
     """Anthill default service."""
+
+    async def on_start(self) -> None:
+        if not settings.SECRET_KEY:
+            raise ImproperlyConfigured('SECRET_KEY environment variable must be set.')
+        await super().on_start()
+        try:
+            await warm_up_db_pool()
+        except Exception:
+            # Pool connects lazily anyway, database may come up later
+            logger.exception('Database connection pool warm up failed.')
@@ -1,7 +1,9 @@
 from .base import *
 
 DEBUG = True
+SECRET_KEY = SECRET_KEY or 'dev-only-insecure-TUYzcAyThoWy9dh6clKHKhdfCy-e68Ka'
 EMAIL_BACKEND = 'anthill.framework.core.mail.backends.console.EmailBackend'
+NPLUSONE_ENABLED = True
 
 LOGGING = {
     'version': 1,
@@ -90,5 +92,9 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False
         },
+        'nplusone': {
+            'handlers': ['console'],
+            'level': 'WARN',
+        },
     }
 }
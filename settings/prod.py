@@ -1 +1,3 @@
 from .base import *
+
+GRAPHENE = dict(GRAPHENE, INTROSPECTION=False)
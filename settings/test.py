@@ -0,0 +1,5 @@
+from .dev import *
+
+# Fail tests on N+1 queries
+NPLUSONE_ENABLED = True
+NPLUSONE_RAISE = True
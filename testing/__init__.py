@@ -0,0 +1,3 @@
+import os
+
+os.environ.setdefault('ANTHILL_SETTINGS_MODULE', 'settings.test')
@@ -0,0 +1,125 @@
+from unittest import TestCase, mock
+from moderation.api.v1 import internal, public
+from moderation.models import ModerationAction
+from datetime import datetime
+import asyncio
+import graphene
+
+
+class DumpModerationsTestCase(TestCase):
+    def setUp(self):
+        self.objects = [
+            ModerationAction(id=i, action_type='ban_account', reason='Spam',
+                             moderator_id=100, user_id=1, is_active=True,
+                             created_at=datetime(2020, 1, 1), finish_at=None)
+            for i in (1, 2)
+        ]
+        query = mock.Mock(**{'all.return_value': self.objects})
+        patcher = mock.patch.object(ModerationAction, 'actions_query', return_value=query)
+        self.actions_query = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(internal, 'db')
+        self.db = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def dump_moderations(self, user_id):
+        async def run():
+            return await internal.dump_moderations(user_id)
+        return asyncio.run(run())
+
+    def test_dump_moderations(self):
+        result = self.dump_moderations('1')
+        self.actions_query.assert_called_once_with('1', columns=ModerationAction.DUMP_FIELDS)
+        self.assertEqual([item['id'] for item in result], [1, 2])
+        self.assertEqual(set(result[0]), set(ModerationAction.DUMP_FIELDS))
+
+    def test_session_removed(self):
+        self.dump_moderations('1')
+        self.db.session.remove.assert_called_once_with()
+
+    def test_session_removed_on_error(self):
+        self.actions_query.return_value.all.side_effect = RuntimeError
+        with self.assertRaises(RuntimeError):
+            self.dump_moderations('1')
+        self.db.session.remove.assert_called_once_with()
+
+
+class Query(graphene.ObjectType):
+    hello = graphene.String()
+
+    def resolve_hello(self, info):
+        return 'world'
+
+
+class GraphQLBackendTestCase(TestCase):
+    def setUp(self):
+        self.graphene_settings = {'INTROSPECTION': True}
+        patcher = mock.patch.object(public, 'settings', mock.Mock(GRAPHENE=self.graphene_settings))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(public, 'validate', wraps=public.validate)
+        self.validate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def schema(self):
+        return public.Schema(query=Query, backend=public.get_backend())
+
+    def test_cache_hit_skips_parse_and_validate(self):
+        schema = self.schema()
+        with mock.patch.object(public.GraphQLCoreBackend, 'document_from_string',
+                               autospec=True,
+                               side_effect=public.GraphQLCoreBackend.document_from_string) as parse:
+            results = [schema.execute('{ hello }') for _ in range(2)]
+        self.assertEqual([result.data for result in results], [{'hello': 'world'}] * 2)
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(self.validate.call_count, 1)
+
+    def test_invalid(self):
+        result = self.schema().execute('{ missing }')
+        self.assertTrue(result.invalid)
+        self.assertEqual(len(result.errors), 1)
+
+    def test_invalid_cached(self):
+        schema = self.schema()
+        results = [schema.execute('{ missing }') for _ in range(2)]
+        self.assertTrue(all(result.invalid for result in results))
+        self.assertEqual(self.validate.call_count, 1)
+
+    def test_introspection_disabled(self):
+        self.graphene_settings['INTROSPECTION'] = False
+        schema = self.schema()
+        for query in ('{ __schema { queryType { name } } }', '{ __type(name: "Query") { name } }'):
+            result = schema.execute(query)
+            self.assertTrue(result.invalid, query)
+            self.assertEqual([error.message for error in result.errors],
+                             ['Schema introspection is disabled.'])
+        result = schema.execute('{ __typename }')
+        self.assertFalse(result.invalid)
+        self.assertEqual(result.data, {'__typename': 'Query'})
+
+    def test_introspection_enabled(self):
+        result = self.schema().execute('{ __schema { queryType { name } } }')
+        self.assertFalse(result.invalid)
+        self.assertEqual(result.data, {'__schema': {'queryType': {'name': 'Query'}}})
+
+    def test_default_backend_untouched(self):
+        from graphql.backend import get_default_backend
+        self.assertNotIsInstance(get_default_backend(), public.GraphQLCachedBackend)
+        self.assertIsInstance(public.schema.backend, public.GraphQLCachedBackend)
+
+
+class DocumentCacheTestCase(TestCase):
+    def test_least_recently_used_evicted(self):
+        cache = public.DocumentCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+        self.assertEqual(list(cache), ['a', 'c'])
+
+    def test_backend_cache_size(self):
+        cache = public.get_backend().cache_map
+        for i in range(public.DOCUMENT_CACHE_SIZE + 1):
+            cache[i] = i
+        self.assertEqual(len(cache), public.DOCUMENT_CACHE_SIZE)
+        self.assertNotIn(0, cache)
@@ -0,0 +1,507 @@
+from unittest import TestCase, mock, skipUnless
+from anthill.framework.db import db
+from moderation import models
+from moderation.cache import warning_threshold_key, WARNING_THRESHOLD_TIMEOUT
+from moderation.models import ModerationAction, ModerationWarning, ModerationWarningThreshold
+from sqlalchemy import create_engine, event, func, insert, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import scoped_session, sessionmaker
+from datetime import datetime
+import asyncio
+import os
+import threading
+import time
+
+# Postgres database for tests needing it, tables are created in a temporary schema
+TEST_DATABASE_URL = os.environ.get('MODERATION_TEST_DATABASE_URL')
+TEST_SCHEMA = 'moderation_test'
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class BulkWarnTestCase(TestCase):
+    threshold = 3
+
+    def setUp(self):
+        self.calls = mock.Mock()
+        self.moderated = []
+        self.warns_counts = {}
+        self.active_keys = set()
+        self.calls.get_threshold.side_effect = lambda action_type: self.threshold
+
+        async def notify(user, subject, message):
+            self.calls.notify(user, subject=subject, message=message)
+
+        patchers = [
+            mock.patch.object(models, 'db', self.calls.db),
+            mock.patch.object(ModerationWarning, 'lock_warnings', self.calls.lock_warnings),
+            mock.patch.object(ModerationWarning, 'insert_warnings',
+                              mock.Mock(side_effect=lambda rows: self.warns_counts)),
+            mock.patch.object(ModerationWarning, 'get_threshold', self.calls.get_threshold),
+            mock.patch.object(ModerationAction, 'insert_actions', self.calls.insert_actions),
+            mock.patch.object(ModerationAction, 'active_keys',
+                              mock.Mock(side_effect=lambda keys: self.active_keys & keys)),
+            mock.patch.object(models.BaseModerationAction, 'notify', notify),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def entry(user, action_type='ban_account', reason='Spam'):
+        return dict(action_type=action_type, reason=reason,
+                    moderator=FakeUser(100), user=user)
+
+    def bulk_warn(self, entries):
+        asyncio.run(ModerationWarning.bulk_warn(entries))
+
+    def call_names(self):
+        return [name for name, args, kwargs in self.calls.mock_calls]
+
+    def test_empty(self):
+        self.bulk_warn([])
+        self.assertEqual(self.calls.mock_calls, [])
+
+    def test_below_threshold(self):
+        user = FakeUser(1)
+        self.warns_counts = {(1, 'ban_account'): self.threshold - 1}
+        self.bulk_warn([self.entry(user)])
+        self.calls.insert_actions.assert_not_called()
+        self.calls.notify.assert_called_once_with(
+            user, subject=mock.ANY, message='Spam')
+        self.assertLess(self.call_names().index('db.session.commit'),
+                        self.call_names().index('notify'))
+
+    def test_threshold_moderates_once_per_key(self):
+        user, other = FakeUser(1), FakeUser(2)
+        first = self.entry(user, reason='first')
+        last = self.entry(user, reason='last')
+        other_entry = self.entry(other)
+        self.warns_counts = {
+            (1, 'ban_account'): self.threshold + 1,
+            (2, 'ban_account'): 1,
+        }
+        self.bulk_warn([first, last, other_entry])
+
+        self.calls.insert_actions.assert_called_once_with([last])
+        # Moderated user is told about moderation only, other user is warned
+        self.assertCountEqual(
+            [(c[1][0], c[2]['message']) for c in self.calls.notify.mock_calls],
+            [(user, 'last'), (other, 'Spam')])
+        # Nobody is notified before commit
+        names = self.call_names()
+        self.assertLess(names.index('db.session.commit'), names.index('notify'))
+
+    def test_already_moderated_not_moderated_again(self):
+        user = FakeUser(1)
+        self.warns_counts = {(1, 'ban_account'): self.threshold + 1}
+        self.active_keys = {(1, 'ban_account')}
+        self.bulk_warn([self.entry(user)])
+        self.calls.insert_actions.assert_not_called()
+        self.calls.notify.assert_called_once_with(
+            user, subject=mock.ANY, message='Spam')
+
+    def test_notify_failure_logged(self):
+        user, other = FakeUser(1), FakeUser(2)
+        self.warns_counts = {(1, 'ban_account'): 1, (2, 'ban_account'): 1}
+
+        async def notify(user_, subject, message):
+            self.calls.notify(user_, subject=subject, message=message)
+            if user_ is user:
+                raise RuntimeError
+
+        with mock.patch.object(models.BaseModerationAction, 'notify', notify), \
+                self.assertLogs('anthill.application', 'ERROR') as logs:
+            self.bulk_warn([self.entry(user), self.entry(other)])
+
+        # Warnings are saved and other user is still notified
+        self.assertEqual(len(self.calls.notify.mock_calls), 2)
+        self.calls.db.session.commit.assert_called_once_with()
+        self.calls.db.session.rollback.assert_not_called()
+        self.assertEqual([record.getMessage() for record in logs.records],
+                         ['Cannot notify user 1.'])
+
+    def test_thresholds_resolved_once_before_locks(self):
+        self.warns_counts = {(1, 'ban_account'): 1, (2, 'ban_account'): 1, (1, 'hide_message'): 1}
+        self.bulk_warn([
+            self.entry(FakeUser(1)),
+            self.entry(FakeUser(2)),
+            self.entry(FakeUser(1), action_type='hide_message'),
+        ])
+        self.assertCountEqual(self.calls.get_threshold.call_args_list,
+                              [mock.call('ban_account'), mock.call('hide_message')])
+        names = self.call_names()
+        self.assertLess(max(i for i, name in enumerate(names) if name == 'get_threshold'),
+                        names.index('lock_warnings'))
+
+    def test_locks_in_sorted_order(self):
+        self.warns_counts = {(1, 'hide_message'): 1, (1, 'ban_account'): 1, (2, 'ban_account'): 1}
+        self.bulk_warn([
+            self.entry(FakeUser(2)),
+            self.entry(FakeUser(1), action_type='hide_message'),
+            self.entry(FakeUser(1)),
+        ])
+        self.assertEqual(self.calls.lock_warnings.call_args_list, [
+            mock.call(1, 'ban_account'),
+            mock.call(1, 'hide_message'),
+            mock.call(2, 'ban_account'),
+        ])
+
+    def test_rollback_on_error(self):
+        self.calls.insert_actions.side_effect = RuntimeError
+        self.warns_counts = {(1, 'ban_account'): self.threshold}
+        with self.assertRaises(RuntimeError):
+            self.bulk_warn([self.entry(FakeUser(1))])
+        self.calls.db.session.rollback.assert_called_once_with()
+        self.calls.db.session.commit.assert_not_called()
+        self.calls.notify.assert_not_called()
+
+
+class ModerateTestCase(TestCase):
+    def setUp(self):
+        self.calls = mock.Mock()
+        self.calls.insert_actions.return_value = [7]
+
+        async def notify(user, subject, message):
+            self.calls.notify(user, subject, message)
+
+        patchers = [
+            mock.patch.object(models, 'db', self.calls.db),
+            mock.patch.object(ModerationAction, 'insert_actions', self.calls.insert_actions),
+            mock.patch.object(models.BaseModerationAction, 'notify', notify),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def moderate(self, user, commit=True):
+        return asyncio.run(ModerationAction.moderate(
+            'ban_account', 'Spam', FakeUser(100), user, commit=commit))
+
+    def test_moderate(self):
+        user = FakeUser(1)
+        self.assertEqual(self.moderate(user), 7)
+        self.calls.db.session.commit.assert_called_once_with()
+        self.calls.notify.assert_called_once_with(user, mock.ANY, 'Spam')
+
+    def test_moderate_without_commit(self):
+        self.assertEqual(self.moderate(FakeUser(1), commit=False), 7)
+        self.calls.insert_actions.assert_called_once()
+        self.calls.db.session.commit.assert_not_called()
+        self.calls.notify.assert_not_called()
+
+
+class ActionTypeTestCase(TestCase):
+    def test_validate_action_type(self):
+        for action_type, label in models.ACTION_TYPES:
+            self.assertEqual(models.validate_action_type(action_type), action_type)
+        with self.assertRaises(ValueError):
+            models.validate_action_type('unknown')
+
+    def test_validates_on_models(self):
+        for model in (ModerationAction, ModerationWarning, ModerationWarningThreshold):
+            self.assertEqual(model(action_type='ban_game').action_type, 'ban_game')
+            with self.assertRaises(ValueError):
+                model(action_type='unknown')
+            obj = model(action_type='ban_game')
+            with self.assertRaises(ValueError):
+                obj.action_type = 'unknown'
+
+    def test_entry_rows_validated(self):
+        entry = BulkWarnTestCase.entry(FakeUser(1), action_type='unknown')
+        with self.assertRaises(ValueError):
+            ModerationWarning.entry_rows([entry], datetime(2020, 1, 1))
+
+
+class ThresholdCacheTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(models, 'cache')
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(ModerationWarningThreshold, 'query')
+        self.query = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.first = self.query.filter_by.return_value.first
+
+    def test_miss(self):
+        self.cache.get.return_value = None
+        self.first.return_value = ModerationWarningThreshold(action_type='ban_game', value=5)
+        self.assertEqual(ModerationWarning.get_threshold('ban_game'), 5)
+        key = warning_threshold_key('ban_game')
+        self.cache.get.assert_called_once_with(key)
+        self.query.filter_by.assert_called_once_with(action_type='ban_game')
+        self.cache.set.assert_called_once_with(key, 5, WARNING_THRESHOLD_TIMEOUT)
+
+    def test_hit(self):
+        self.cache.get.return_value = 4
+        self.assertEqual(ModerationWarning.get_threshold('ban_game'), 4)
+        self.query.filter_by.assert_not_called()
+        self.cache.set.assert_not_called()
+
+    def test_default(self):
+        self.cache.get.return_value = None
+        self.first.return_value = None
+        self.assertEqual(ModerationWarning.get_threshold('ban_game'),
+                         models.DEFAULT_MODERATION_WARNING_THRESHOLD)
+        self.cache.set.assert_called_once_with(
+            warning_threshold_key('ban_game'),
+            models.DEFAULT_MODERATION_WARNING_THRESHOLD, WARNING_THRESHOLD_TIMEOUT)
+
+
+class ThresholdInvalidationTestCase(TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        ModerationWarningThreshold.__table__.create(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+        patcher = mock.patch.object(models, 'cache')
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_deleted_after_commit(self):
+        self.session.add(ModerationWarningThreshold(action_type='ban_game', value=5))
+        self.session.flush()
+        self.cache.delete_many.assert_not_called()
+        self.session.commit()
+        self.cache.delete_many.assert_called_once_with({warning_threshold_key('ban_game')})
+
+    def test_action_type_change(self):
+        threshold = ModerationWarningThreshold(action_type='ban_game', value=5)
+        self.session.add(threshold)
+        self.session.commit()
+        self.cache.reset_mock()
+        threshold.action_type = 'hide_message'
+        self.session.commit()
+        # Both old and new action type keys are deleted
+        self.cache.delete_many.assert_called_once_with({
+            warning_threshold_key('ban_game'),
+            warning_threshold_key('hide_message'),
+        })
+
+    def test_not_deleted_after_rollback(self):
+        self.session.add(ModerationWarningThreshold(action_type='ban_game', value=5))
+        self.session.flush()
+        self.session.rollback()
+        self.cache.delete_many.assert_not_called()
+
+
+class ActiveActionsSQLTestCase(TestCase):
+    def test_active(self):
+        sql = str(ModerationAction.active.compile(dialect=postgresql.dialect()))
+        self.assertEqual(
+            sql, 'actions.is_active AND (actions.finish_at IS NULL OR actions.finish_at > %(now_1)s)')
+
+    def test_finished(self):
+        sql = str(ModerationAction.finished.compile(dialect=postgresql.dialect()))
+        self.assertEqual(sql, 'actions.finish_at IS NOT NULL AND actions.finish_at <= %(now_1)s')
+
+    def test_now_evaluated_per_execution(self):
+        times = [datetime(2020, 1, 1), datetime(2020, 1, 2)]
+        with mock.patch.object(models.timezone, 'now', side_effect=times):
+            compiled = ModerationAction.active.compile()
+            params = [compiled.construct_params()['now_1'] for _ in times]
+        self.assertEqual(params, times)
+
+
+class ActionsQueryTestCase(TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        # JSONB server default does not compile for sqlite, create table by hand
+        engine.execute("""
+            CREATE TABLE actions (
+                id INTEGER PRIMARY KEY,
+                action_type VARCHAR(32) NOT NULL,
+                moderator_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                created_at DATETIME NOT NULL,
+                reason VARCHAR(512) NOT NULL,
+                is_active BOOLEAN NOT NULL,
+                extra_data TEXT NOT NULL DEFAULT '{}',
+                finish_at DATETIME
+            )
+        """)
+        row = dict(action_type='ban_account', moderator_id=100, user_id=1,
+                   created_at=datetime(2020, 1, 1), reason='Spam', is_active=True)
+        engine.execute(insert(ModerationAction.__table__), [
+            dict(row, id=1, finish_at=None),
+            dict(row, id=2, finish_at=datetime(2000, 1, 1)),  # finished
+            dict(row, id=3, finish_at=datetime(2100, 1, 1)),
+            dict(row, id=4, finish_at=None, is_active=False),
+            dict(row, id=5, finish_at=None, action_type='ban_game'),
+            dict(row, id=6, finish_at=None, user_id=2),
+        ])
+
+        self.statements = []
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+        session = scoped_session(sessionmaker(bind=engine))
+        self.addCleanup(session.remove)
+        patcher = mock.patch.object(models, 'db', mock.Mock(session=session))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+    def ids(self, *args, **kwargs):
+        return sorted(obj.id for obj in ModerationAction.actions_query(*args, **kwargs).all())
+
+    def test_active_filter(self):
+        self.assertEqual(self.ids(1), [1, 3, 5])
+        sql, params = self.statements[-1]
+        self.assertIn('actions.is_active = 1 AND '
+                      '(actions.finish_at IS NULL OR actions.finish_at > ?) AND '
+                      'actions.user_id = ?', sql)
+
+    def test_filters_cached_separately(self):
+        self.assertEqual(self.ids(1, action_type='ban_game'), [5])
+        self.assertEqual(self.ids(1), [1, 3, 5])
+        self.assertEqual(self.ids(1, action_type='ban_account'), [1, 3])
+        self.assertEqual(self.ids(2), [6])
+        self.assertIn('actions.action_type = ?', self.statements[0][0])
+        self.assertNotIn('actions.action_type = ?', self.statements[1][0])
+
+    def test_columns_cached_separately(self):
+        self.ids(1, columns=('id',))
+        self.ids(1)
+        self.ids(1, columns=ModerationAction.DUMP_FIELDS)
+        columns_sql = [sql.split('FROM')[0] for sql, params in self.statements]
+        self.assertNotIn('actions.reason', columns_sql[0])
+        self.assertNotIn('actions.finish_at', columns_sql[0])
+        self.assertIn('actions.reason', columns_sql[1])
+        self.assertNotIn('actions.reason', columns_sql[2])
+        self.assertIn('actions.finish_at', columns_sql[2])
+
+    def test_now_evaluated_per_execution(self):
+        self.ids(1)
+        time.sleep(0.01)
+        self.ids(1)
+        (first_sql, first_params), (second_sql, second_params) = self.statements
+        self.assertEqual(first_sql, second_sql)
+        # Bound time comes first, before user id
+        self.assertLess(first_params[0], second_params[0])
+
+
+class WarningsSQLTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(models, 'db')
+        self.db = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db.session.execute.return_value = []
+
+    def executed_sql(self):
+        stmt = self.db.session.execute.call_args[0][0]
+        return str(stmt.compile(dialect=postgresql.dialect()))
+
+    def test_insert_warnings(self):
+        rows = ModerationWarning.entry_rows([
+            BulkWarnTestCase.entry(FakeUser(1)),
+            BulkWarnTestCase.entry(FakeUser(2), action_type='hide_message'),
+        ], models.timezone.now())
+        ModerationWarning.insert_warnings(rows)
+        self.db.session.execute.assert_called_once()
+        sql = self.executed_sql()
+        self.assertIn('WITH inserted AS \n(INSERT INTO warnings', sql)
+        self.assertIn('RETURNING warnings.user_id, warnings.action_type', sql)
+        self.assertIn('UNION ALL', sql)
+        self.assertIn('(warnings.user_id, warnings.action_type) IN', sql)
+        self.assertTrue(sql.rstrip().endswith(
+            'GROUP BY anon_1.user_id, anon_1.action_type'))
+
+    def test_insert_no_warnings(self):
+        self.assertEqual(ModerationWarning.insert_warnings([]), {})
+        self.db.session.execute.assert_not_called()
+
+    def test_lock_warnings(self):
+        ModerationWarning.lock_warnings(1, 'ban_account')
+        sql = self.executed_sql()
+        self.assertIn('SELECT pg_advisory_xact_lock(', sql)
+        self.assertIn('hashtext(', sql)
+
+
+@skipUnless(TEST_DATABASE_URL, 'MODERATION_TEST_DATABASE_URL is not set')
+class PostgresTestCase(TestCase):
+    def setUp(self):
+        engine = create_engine(TEST_DATABASE_URL)
+        self.addCleanup(engine.dispose)
+        engine.execute('CREATE SCHEMA %s' % TEST_SCHEMA)
+        self.addCleanup(engine.execute, 'DROP SCHEMA %s CASCADE' % TEST_SCHEMA)
+        self.engine = engine.execution_options(schema_translate_map={None: TEST_SCHEMA})
+        tables = [ModerationWarning.__table__, ModerationAction.__table__]
+        db.Model.metadata.create_all(self.engine, tables=tables)
+
+        # Thread local sessions, like the service ones
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        self.addCleanup(self.session.remove)
+
+        async def notify(user, subject, message):
+            pass
+
+        patchers = [
+            mock.patch.object(models, 'db', mock.Mock(session=self.session)),
+            mock.patch.object(models.BaseModerationAction, 'notify', notify),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def count(self, model):
+        stmt = select([func.count()]).select_from(model.__table__)
+        return self.engine.execute(stmt).scalar()
+
+
+class ModerateInTransactionTestCase(PostgresTestCase):
+    def moderate(self):
+        return asyncio.run(ModerationAction.moderate(
+            'ban_account', 'Spam', FakeUser(100), FakeUser(1), commit=False))
+
+    def test_committed_by_caller(self):
+        self.moderate()
+        self.assertEqual(self.count(ModerationAction), 0)
+        self.session.commit()
+        self.assertEqual(self.count(ModerationAction), 1)
+
+    def test_rolled_back_by_caller(self):
+        self.moderate()
+        self.session.rollback()
+        self.assertEqual(self.count(ModerationAction), 0)
+
+
+class ConcurrentWarnTestCase(PostgresTestCase):
+    threshold = 3
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(ModerationWarning, 'get_threshold',
+                                    mock.Mock(return_value=self.threshold))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_warnings_at_threshold(self):
+        user = FakeUser(1)
+        entry = BulkWarnTestCase.entry(user)
+        rows = ModerationWarning.entry_rows([entry] * (self.threshold - 1), models.timezone.now())
+        self.engine.execute(insert(ModerationWarning.__table__), rows)
+
+        barrier = threading.Barrier(2)
+        errors = []
+
+        def target():
+            try:
+                barrier.wait()
+                asyncio.run(ModerationWarning.bulk_warn([entry]))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=target) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.count(ModerationWarning), self.threshold + 1)
+        self.assertEqual(self.count(ModerationAction), 1)
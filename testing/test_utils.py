@@ -0,0 +1,123 @@
+from unittest import TestCase, mock
+from nplusone.core.exceptions import NPlusOneError
+import nplusone.ext.sqlalchemy  # noqa: F401, as utils does with NPLUSONE_ENABLED
+from sqlalchemy import Column, ForeignKey, Integer, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import StaticPool
+from moderation import utils
+import logging
+import threading
+
+Base = declarative_base()
+
+
+class Parent(Base):
+    __tablename__ = 'parents'
+
+    id = Column(Integer, primary_key=True)
+    children = relationship('Child')
+
+
+class Child(Base):
+    __tablename__ = 'children'
+
+    id = Column(Integer, primary_key=True)
+    parent_id = Column(Integer, ForeignKey('parents.id'))
+
+
+class NPlusOneProfilerTestCase(TestCase):
+    def setUp(self):
+        # One shared connection, so other threads see the same in-memory database
+        engine = create_engine('sqlite://', poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+        Base.metadata.create_all(engine)
+        self.Session = sessionmaker(bind=engine)
+        session = self.Session()
+        session.add_all([Parent(children=[Child()]) for _ in range(2)])
+        session.commit()
+        session.close()
+
+        settings = mock.Mock(NPLUSONE_ENABLED=True, NPLUSONE_RAISE=True)
+        patcher = mock.patch.object(utils, 'settings', settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def load_children(self):
+        session = self.Session()
+        try:
+            return [parent.children for parent in session.query(Parent).all()]
+        finally:
+            session.close()
+
+    def test_lazy_load_detected(self):
+        with self.assertRaises(NPlusOneError):
+            with utils.nplusone_profiler():
+                self.load_children()
+
+    def test_other_thread_ignored(self):
+        results = []
+
+        def target():
+            try:
+                results.append(len(self.load_children()))
+            except Exception as e:
+                results.append(e)
+
+        with utils.nplusone_profiler():
+            thread = threading.Thread(target=target)
+            thread.start()
+            thread.join()
+        self.assertEqual(results, [2])
+
+    def test_disabled(self):
+        utils.settings.NPLUSONE_ENABLED = False
+        with utils.nplusone_profiler():
+            self.assertEqual(len(self.load_children()), 2)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.messages = []
+
+    def emit(self, record):
+        self.records.append(record)
+        self.messages.append(self.format(record))
+
+
+class BackgroundHandlerTestCase(TestCase):
+    def setUp(self):
+        self.handler = utils.BackgroundHandler({'class': __name__ + '.RecordingHandler'})
+        self.handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+        self.addCleanup(self.handler.close)
+        self.logger = logging.getLogger('moderation.testing.background')
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def test_record_passed_with_exc_info(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('Failed %s', 'task')
+        self.handler.listener.stop()
+        self.handler.listener = None
+
+        record, = self.handler.handler.records
+        self.assertIs(record.exc_info[0], ValueError)
+        self.assertEqual(record.msg, 'Failed task')
+        self.assertIsNone(record.args)
+        message, = self.handler.handler.messages
+        self.assertTrue(message.startswith('[ERROR] Failed task\nTraceback'))
+
+    def test_message_rendered_at_call_time(self):
+        items = ['first']
+        self.logger.warning('Items: %s', items)
+        items.append('second')
+        self.handler.listener.stop()
+        self.handler.listener = None
+
+        message, = self.handler.handler.messages
+        self.assertEqual(message, "[WARNING] Items: ['first']")
@@ -0,0 +1,117 @@
+from anthill.framework.conf import settings
+from contextlib import nullcontext
+from logging.handlers import QueueHandler, QueueListener
+import copy
+import importlib
+import logging
+import os
+import queue
+import threading
+
+try:
+    from nplusone.core import notifiers, profiler, signals
+except ImportError:  # development dependency
+    profiler = None
+
+
+if profiler is not None:
+    if settings.NPLUSONE_ENABLED:
+        # Scope nplusone signals to the thread they are sent from,
+        # so profiling one block ignores loads made by other threads.
+        # Blinker before 1.7 matches non-str senders by identity, so it must be
+        # the same object for every call from the thread (a thread id int is not).
+        signals.get_worker = lambda *args, **kwargs: threading.current_thread()
+
+        # Patch SQLAlchemy on import: lazy loaders bind their loading
+        # function when mappers are configured, so patching later misses them.
+        import nplusone.ext.sqlalchemy  # noqa: F401
+
+    class NPlusOneProfiler(profiler.Profiler):
+        """Profiler reporting to configured notifiers instead of always raising."""
+
+        def __init__(self, config, whitelist=None):
+            super().__init__(whitelist)
+            self.notifiers = notifiers.init(config)
+
+        def notify(self, message):
+            if not message.match(self.whitelist):
+                for notifier in self.notifiers:
+                    notifier.notify(message)
+
+
+def nplusone_profiler():
+    """
+    Context manager detecting lazy loads (N+1 queries) inside the block.
+    Enabled with `NPLUSONE_ENABLED` setting, raises if `NPLUSONE_RAISE` is set,
+    otherwise reports to `nplusone` logger.
+
+    Detection is scoped to the current thread, so the block must load and
+    use the objects synchronously: no `await` and no executor calls inside.
+    """
+    if not settings.NPLUSONE_ENABLED:
+        return nullcontext()
+    return NPlusOneProfiler({
+        'NPLUSONE_LOGGER': logging.getLogger('nplusone'),
+        'NPLUSONE_LOG_LEVEL': logging.WARN,
+        'NPLUSONE_RAISE': settings.NPLUSONE_RAISE,
+    })
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Pass log records to wrapped handler through a queue,
+    so slow handlers (file) are run on a listener thread
+    instead of the logging caller.
+
+    Level and filters are applied before queueing, formatter is passed
+    to wrapped handler; `handler` is a config dict of wrapped handler
+    with `class` key.
+    Message is rendered in the logging thread, so arguments are logged
+    in their state at call time, then a record copy is queued with
+    `exc_info` and formatted by wrapped handler on the listener thread,
+    so handlers using the record itself (e.g. admin email handler) work too.
+    """
+
+    def __init__(self, handler: dict):
+        super().__init__(queue.Queue(-1))
+        handler = dict(handler)
+        module_path, class_name = handler.pop('class').rsplit('.', 1)
+        handler_class = getattr(importlib.import_module(module_path), class_name)
+        self.handler = handler_class(**handler)
+        self.listener = None
+        self.pid = None
+
+    def start_listener(self) -> None:
+        # Listener thread does not survive fork, so start it per process
+        self.queue = queue.Queue(-1)
+        self.listener = QueueListener(self.queue, self.handler)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Not formatted here: wrapped handler applies formatter itself.
+        # Records are only passed within the process, no need to make them picklable.
+        message = record.getMessage()
+        record = copy.copy(record)
+        record.msg = message
+        record.args = None
+        return record
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            # Handler lock is reinitialized after fork by logging module
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start_listener()
+        super().emit(record)
+
+    def close(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+        self.handler.close()
+        super().close()